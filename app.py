@@ -1,18 +1,30 @@
 import os
 import re
 import sys
+import logging
 import json
 import requests
-import pandas as pd
-from flask import Flask, render_template, request, redirect, url_for, session, Response, flash
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file
+from bs4 import BeautifulSoup, SoupStrainer
+try:
+    from selectolax.lexbor import LexborHTMLParser
+    SELECTOLAX_AVAILABLE = True
+except ImportError:
+    SELECTOLAX_AVAILABLE = False
 from datetime import datetime, timezone, timedelta
-from io import BytesIO
-from urllib.parse import quote
+from html import unescape
 import threading
+from functools import lru_cache
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import time
 
 # --- Google Sheets & ReportLab ---
 import gspread
+from gspread.utils import rowcol_to_a1
 from google.oauth2.service_account import Credentials
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
@@ -26,9 +38,16 @@ from reportlab.lib.units import cm
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24))
 
+# --- 日誌設定 (以環境變數 LOG_LEVEL 調整，預設 INFO) ---
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
+
 # --- 路徑設定 ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FONT_PATH = os.path.join(BASE_DIR, 'NotoSansTC-Regular.ttf')
+PDF_CACHE_DIR = os.path.join(BASE_DIR, '.pdf_cache')
+PDF_CACHE_MAX_FILES = 500  # 超過此數量時依修改時間淘汰最舊的 PDF
+CERT_CACHE_MAX_AGE = 86400  # 瀏覽器快取證書的秒數
+os.makedirs(PDF_CACHE_DIR, exist_ok=True)
 
 # --- 字型註冊 ---
 if os.path.exists(FONT_PATH):
@@ -38,6 +57,21 @@ else:
     print("警告：中文字型 'NotoSansTC-Regular.ttf' 未找到。PDF 中的中文可能無法正常顯示。", file=sys.stderr)
     FONT_AVAILABLE = False
 
+# --- 證書版面 ---
+# 固定不變的標題文字在啟動時先算好置中座標，每次產生 PDF 時不必再量測字寬
+CERT_FONT = 'NotoSansTC' if FONT_AVAILABLE else 'Helvetica'
+PAGE_WIDTH, PAGE_HEIGHT = letter
+TITLE_X = (PAGE_WIDTH - pdfmetrics.stringWidth("完賽證明", CERT_FONT, 36)) / 2.0
+SUBTITLE_X = (PAGE_WIDTH - pdfmetrics.stringWidth("挑戰成功", CERT_FONT, 18)) / 2.0
+# 各項數據的標籤 (標籤, 活動欄位, y 座標) 與其字寬，每次只需量測數值部分
+CERT_STAT_LINES = (
+    ("總距離：", 'distance', PAGE_HEIGHT - 350),
+    ("總時長：", 'time', PAGE_HEIGHT - 400),
+    ("最高海拔：", 'elevation_gain', PAGE_HEIGHT - 450),
+    ("平均配速：", 'avg_pace', PAGE_HEIGHT - 500),
+)
+CERT_LABEL_WIDTHS = {label: pdfmetrics.stringWidth(label, CERT_FONT, 18) for label, _, _ in CERT_STAT_LINES}
+
 # --- Google Sheets 設定 ---
 try:
     creds_json_str = os.environ.get('GOOGLE_CREDENTIALS_JSON')
@@ -63,8 +97,63 @@ except Exception as e:
     print(f"錯誤詳細資訊: {repr(e)}", file=sys.stderr)
     GSPREAD_AVAILABLE = False
     
+# --- HTTP 連線設定 ---
+# 共用 Session 以重複使用 keep-alive 連線，省去每次爬取的 TCP/TLS 交握
+HTTP_TIMEOUT = (5, 15)  # (連線, 讀取) 逾時秒數
+# Strava 沿用原本的瀏覽器識別字串
+STRAVA_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+# Garmin 依語系輸出 meta 內容，固定要求英文才能以 _GARMIN_*_RE 解析
+GARMIN_HEADERS = {'Accept-Language': 'en-US,en;q=0.9'}
+http_session = requests.Session()
+http_session.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
+_http_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                            max_retries=Retry(total=2, backoff_factor=0.2))
+http_session.mount('https://', _http_adapter)
+http_session.mount('http://', _http_adapter)  # 使用者貼上的 http:// 網址同樣走連線池與重試
+
+# --- 預先編譯的正規表示式 ---
+# 直接在原始位元組中比對 Garmin 的 og:description meta 標籤，免去解析整份 HTML
+# (屬性順序不固定，兩種排列都直接比對)
+_GARMIN_META_RE = re.compile(
+    rb'<meta\s[^>]*?(?:property="og:description"[^>]*?content="([^"]*)"'
+    rb'|content="([^"]*)"[^>]*?property="og:description")'
+)
+# 直接在原始位元組中取出 Strava 統計數值格的內容 (數值內可能含 <abbr> 單位標籤，另行去除)
+_STRAVA_STAT_RE = re.compile(rb'<div class="Stat_statValue__lmw2H"[^>]*>(.*?)</div>', re.S)
+_TAG_RE = re.compile(rb'<[^>]+>')
+# Strava 的 '1h 23m 45s' 時間格式 (數字與單位間可有空白)，一次比對取出時、分、秒
+_HMS_RE = re.compile(r'(?:(\d+)\s*h)?\s*(?:(\d+)\s*m)?\s*(?:(\d+)\s*s)?')
+# og:description 內容中的各項數據
+_GARMIN_DIST_RE = re.compile(r'Distance ([\d\.]+) km')
+_GARMIN_TIME_RE = re.compile(r'Time ([\d:]+)')
+_GARMIN_ELEV_RE = re.compile(r'Elevation ([\d]+) m')
+
+# --- BeautifulSoup 備援解析時只建立需要的標籤 ---
+# strainer 以整串 class 屬性比對，需允許同時帶有其他 class 的數值格
+_STRAVA_STAT_STRAINER = SoupStrainer('div', class_=re.compile(r'(?:^|\s)Stat_statValue__lmw2H(?:\s|$)'))
+_GARMIN_META_STRAINER = SoupStrainer('meta', property='og:description')
+
 # --- 全域變數 ---
 gsheet_lock = threading.Lock()
+user_cache_lock = threading.Lock()
+USER_CACHE_TTL = 60  # 使用者資料快取秒數
+USER_CACHE_MISS_TTL = 10  # 登入比對失敗時，快取超過此秒數即重新讀取 (新增或修改的使用者可立即登入)
+_user_cache = {'users': None, 'loaded_at': 0.0}
+SHEET_CACHE_TTL = 60  # 工作表標題列與列索引快取秒數
+_sheet_cache = {'headers': None, 'id_to_row': None, 'loaded_at': 0.0}
+# 背景寫入 Google Sheet 紀錄，寫入本就由 gsheet_lock 序列化，單一執行緒即可
+_log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gsheet-log')
+# 尚未寫入的紀錄 (身分證字號 -> (最新連結, 產生時間))；同一使用者連續送出時只保留最後一筆，
+# 佇列長度因此不超過使用者人數
+_pending_logs = {}
+_pending_logs_lock = threading.Lock()
+# 已爬取的活動資料 (平台, 網址) -> (資料, 取得時間)；使用者常重複送出同一網址
+activity_cache_lock = threading.Lock()
+ACTIVITY_CACHE_TTL = 600  # 活動資料快取秒數
+ACTIVITY_CACHE_MAX_ENTRIES = 256
+_activity_cache = {}
 
 # ==============================================================================
 # 輔助函式
@@ -72,34 +161,34 @@ gsheet_lock = threading.Lock()
 def seconds_to_hms(seconds):
     """將秒數轉換為 時:分:秒 的格式。"""
     if seconds is None: return "N/A"
-    seconds = int(seconds)
+    return _format_hms(int(seconds))
+
+@lru_cache(maxsize=1024)
+def _format_hms(seconds):
+    """seconds_to_hms 的快取實作，常見的整數秒數只需格式化一次。"""
     hours, remainder = divmod(seconds, 3600)
     minutes, seconds = divmod(remainder, 60)
     return f"{hours:02}:{minutes:02}:{seconds:02}"
 
 def hms_to_seconds(t):
     """將 '1h 23m 45s' 或 'hh:mm:ss' 或 'mm:ss' 格式的時間字串轉換為總秒數"""
-    h, m, s = 0, 0, 0
     if not isinstance(t, str):
         return 0
     
-    if 'h' in t or 'm' in t or 's' in t: # 處理 Strava 的 '1h 23m 45s' 格式
-        if 'h' in t:
-            h = int(t.split('h')[0])
-            t = t.split('h')[1].strip()
-        if 'm' in t:
-            m = int(t.split('m')[0])
-            t = t.split('m')[1].strip()
-        if 's' in t:
-            s = int(t.split('s')[0])
-        return h * 3600 + m * 60 + s
-    elif ':' in t: # 處理 Garmin meta tag 的 'hh:mm:ss' 或 'mm:ss' 格式
+    if ':' in t: # 處理 Garmin meta tag 的 'hh:mm:ss' 或 'mm:ss' 格式
         parts = list(map(int, t.split(':')))
         if len(parts) == 3: # hh:mm:ss
             return parts[0] * 3600 + parts[1] * 60 + parts[2]
         elif len(parts) == 2: # mm:ss
             return parts[0] * 60 + parts[1]
-    return 0
+        return 0
+
+    # 處理 Strava 的 '1h 23m 45s' 格式，單次比對即可取出時、分、秒
+    match = _HMS_RE.fullmatch(t.strip())
+    if not match:
+        return 0
+    h, m, s = (int(value) if value else 0 for value in match.groups())
+    return h * 3600 + m * 60 + s
 
 
 def calculate_pace(distance_km, total_seconds):
@@ -117,21 +206,27 @@ def calculate_pace(distance_km, total_seconds):
 def get_strava_data(url):
     """從 Strava 活動頁面爬取資料"""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers)
+        response = http_session.get(url, headers=STRAVA_HEADERS, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
 
-        soup = BeautifulSoup(response.text, 'html.parser')
-        stats = soup.find_all('div', class_='Stat_statValue__lmw2H')
+        # 先以正規表示式直接比對統計數值，找不到時才解析 HTML
+        # (優先使用 selectolax (C 實作) 解析，未安裝時退回 BeautifulSoup)
+        stats = [unescape(_TAG_RE.sub(b'', raw).decode('utf-8', errors='replace'))
+                 for raw in _STRAVA_STAT_RE.findall(response.content)]
+        if len(stats) < 3:
+            if SELECTOLAX_AVAILABLE:
+                tree = LexborHTMLParser(response.content)
+                stats = [node.text() for node in tree.css('div.Stat_statValue__lmw2H')]
+            else:
+                soup = BeautifulSoup(response.content, 'lxml', parse_only=_STRAVA_STAT_STRAINER)
+                stats = [div.text for div in soup.find_all('div', class_='Stat_statValue__lmw2H')]
         
         if len(stats) < 3:
             return {'error': '無法在頁面上找到足夠的統計數據，請確認網址是否為公開活動。'}
 
-        distance_str = stats[0].text.replace('km', '').strip()
-        time_str = stats[1].text
-        elevation_str = stats[2].text.replace('m', '').replace(',', '').strip()
+        distance_str = stats[0].replace('km', '').strip()
+        time_str = stats[1]
+        elevation_str = stats[2].replace('m', '').replace(',', '').strip()
 
         distance = float(distance_str)
         total_seconds = hms_to_seconds(time_str)
@@ -154,28 +249,31 @@ def get_garmin_data(url):
     這個方法最為穩定，因為 meta 標籤是設計給爬蟲讀取的。
     """
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36',
-            'Accept-Language': 'en-US,en;q=0.9',
-        }
-        response = requests.get(url, headers=headers)
+        # 完整讀取回應，連線才能歸還連線池重複使用 (提早中斷會讓 urllib3 關閉連線)
+        response = http_session.get(url, headers=GARMIN_HEADERS, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # 找到 property 為 'og:description' 的 meta 標籤
-        meta_tag = soup.find('meta', property='og:description')
+        page = response.content
+
+        # 找到 property 為 'og:description' 的 meta 標籤，正規表示式比對失敗時才解析 HTML
+        meta_match = _GARMIN_META_RE.search(page)
+        if meta_match:
+            raw_content = meta_match.group(1) if meta_match.group(1) is not None else meta_match.group(2)
+            content = unescape(raw_content.decode('utf-8', errors='replace'))
+        elif SELECTOLAX_AVAILABLE:
+            meta_tag = LexborHTMLParser(page).css_first('meta[property="og:description"]')
+            content = meta_tag.attributes.get('content') if meta_tag else None
+        else:
+            meta_tag = BeautifulSoup(page, 'lxml', parse_only=_GARMIN_META_STRAINER).find('meta', property='og:description')
+            content = meta_tag.get('content') if meta_tag else None
         
-        if not meta_tag or not meta_tag.get('content'):
+        if not content:
             return {'error': '無法在 Garmin 頁面中找到活動的 meta 資訊。請確認活動為公開，或網址正確。'}
-            
-        content = meta_tag.get('content')
         # content 格式: "Distance 6.07 km | Time 36:20 | Pace 5:59 /km | Elevation 7 m"
 
         # 使用正規表示式從 content 字串中提取各項數據
-        dist_match = re.search(r'Distance ([\d\.]+) km', content)
-        time_match = re.search(r'Time ([\d:]+)', content)
-        elev_match = re.search(r'Elevation ([\d]+) m', content)
+        dist_match = _GARMIN_DIST_RE.search(content)
+        time_match = _GARMIN_TIME_RE.search(content)
+        elev_match = _GARMIN_ELEV_RE.search(content)
 
         if not (dist_match and time_match and elev_match):
             return {'error': '從 meta 資訊中解析數據失敗，可能是 Garmin 更改了格式。'}
@@ -190,11 +288,8 @@ def get_garmin_data(url):
         # 重新計算配速以確保格式統一
         avg_pace = calculate_pace(distance_km, total_seconds)
         
-        # 格式化總時間為 hh:mm:ss
-        td = timedelta(seconds=total_seconds)
-        hours, remainder = divmod(td.seconds, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        formatted_time = f"{int(hours):02}:{int(minutes):02}:{int(seconds):02}"
+        # 格式化總時間為 hh:mm:ss (直接以秒數換算，超過 24 小時的活動也不會被截斷)
+        formatted_time = seconds_to_hms(total_seconds)
 
         return {
             'distance': f"{distance_km:.2f} km",
@@ -207,49 +302,248 @@ def get_garmin_data(url):
     except Exception as e:
         return {'error': f'處理 Garmin 資料時發生未預期的錯誤: {e}'}
 
+ACTIVITY_SCRAPERS = {'garmin': get_garmin_data, 'strava': get_strava_data}
+
+def get_activity_data(url_type, url):
+    """依平台爬取活動資料；成功的結果快取 ACTIVITY_CACHE_TTL 秒，重複送出同一網址時不再連線。"""
+    key = (url_type, url.strip())
+    now = time.monotonic()
+    with activity_cache_lock:
+        cached = _activity_cache.get(key)
+        if cached and now - cached[1] < ACTIVITY_CACHE_TTL:
+            return cached[0]
+
+    activity = ACTIVITY_SCRAPERS[url_type](url)
+    if activity and 'error' not in activity:
+        with activity_cache_lock:
+            if len(_activity_cache) >= ACTIVITY_CACHE_MAX_ENTRIES:
+                # 先清掉過期項目，仍已滿時淘汰最早加入的一筆
+                for k in [k for k, (_, ts) in _activity_cache.items() if now - ts >= ACTIVITY_CACHE_TTL]:
+                    del _activity_cache[k]
+                if len(_activity_cache) >= ACTIVITY_CACHE_MAX_ENTRIES:
+                    del _activity_cache[next(iter(_activity_cache))]
+            _activity_cache[key] = (activity, now)
+    return activity
+
 def get_user_data():
+    """讀取使用者工作表的所有儲存格 (含標題列)，失敗時回傳 None。"""
     if not GSPREAD_AVAILABLE: return None
     try:
-        with gsheet_lock: records = worksheet.get_all_records()
-        return pd.DataFrame(records) if records else pd.DataFrame()
+        with gsheet_lock:
+            values = worksheet.get_all_values()
+            # 同一份資料順便更新標題列與列索引快取，省去 update_user_log 的額外請求
+            _load_sheet_cache(values)
+        return values
     except Exception as e:
-        print(f"讀取 Google Sheet 時發生錯誤：{e}", file=sys.stderr)
+        app.logger.error("讀取 Google Sheet 時發生錯誤：%s", e)
         return None
 
-def update_user_log(user_id_card, successful_url):
+def get_users(max_age=USER_CACHE_TTL):
+    """
+    回傳以身分證號 (去空白、大寫) 為鍵的使用者字典，值為該身分證號的所有列 (依工作表順序)。
+    資料快取於記憶體中，超過 max_age 秒才重新讀取 Google Sheet。
+    """
+    # 快取未過期時不取鎖，重新讀取期間其他登入不必等待
+    users = _user_cache['users']
+    if users is not None and time.monotonic() - _user_cache['loaded_at'] < max_age:
+        return users
+    # 已有快取時若其他執行緒正在重新讀取，直接使用舊資料；只有首次載入需要等待
+    if not user_cache_lock.acquire(blocking=users is None):
+        return users
+    try:
+        if _user_cache['users'] is not None and time.monotonic() - _user_cache['loaded_at'] < max_age:
+            return _user_cache['users']
+
+        values = get_user_data()
+        if values is None: return None
+        headers = values[0] if values else []
+        if len(values) > 1 and not all(col in headers for col in ['id_card', 'phone']):
+            app.logger.error("使用者資料表缺少 'id_card' 或 'phone' 欄位。")
+            return None
+
+        # 欄位在讀取時一次性正規化，登入時只需一次字典查詢與字串比對
+        users = {}
+        for row in values[1:]:
+            user = dict(zip(headers, row))
+            user['id_card'] = user.get('id_card', '').strip().upper()
+            user['phone'] = user.get('phone', '').strip()
+            # 略過空白列，避免空白的身分證號與手機號碼可以登入
+            if not user['id_card']: continue
+            users.setdefault(user['id_card'], []).append(user)
+        _user_cache['users'] = users
+        _user_cache['loaded_at'] = time.monotonic()
+        return users
+    finally:
+        user_cache_lock.release()
+
+def find_user(users, id_card, phone):
+    """依身分證號與手機號碼查詢使用者，手機號碼可省略開頭的 0 (試算表會將其去除)。"""
+    phone_no_zero = phone[1:] if phone.startswith('0') else phone
+    # 身分證號重複時，取第一筆手機號碼也相符的資料
+    for user_info in users.get(id_card, ()):
+        if user_info['phone'] in (phone, phone_no_zero):
+            return user_info
+    return None
+
+def _load_sheet_cache(values):
+    """由工作表完整內容建立標題列與 身分證號 -> 列號 的索引 (呼叫端須持有 gsheet_lock)。"""
+    headers = values[0] if values else []
+    id_col = headers.index('id_card') if 'id_card' in headers else 1
+    id_to_row = {}
+    for row_number, row in enumerate(values[1:], start=2):
+        id_card = str(row[id_col]).strip().upper() if len(row) > id_col else ''
+        # 略過空白列；身分證號重複時以第一列為準
+        if id_card and id_card not in id_to_row:
+            id_to_row[id_card] = row_number
+    _sheet_cache['headers'] = list(headers)
+    _sheet_cache['id_to_row'] = id_to_row
+    _sheet_cache['loaded_at'] = time.monotonic()
+
+def invalidate_sheet_cache():
+    """清除標題列與列索引快取，下次使用時重新讀取工作表。"""
+    _sheet_cache['id_to_row'] = None
+
+def _get_sheet_cache(force=False):
+    """取得工作表快取，過期或 force=True 時以單次 get_all_values 重新載入 (呼叫端須持有 gsheet_lock)。"""
+    if force or _sheet_cache['id_to_row'] is None or time.monotonic() - _sheet_cache['loaded_at'] >= SHEET_CACHE_TTL:
+        _load_sheet_cache(worksheet.get_all_values())
+    return _sheet_cache
+
+def log_timestamp():
+    """回傳目前的台灣時間 (UTC+8)，格式為 'YYYY-MM-DD HH:MM:SS'。"""
+    # --- 時區修正 ---
+    # 1. 定義 UTC+8 時區 (台灣時間)
+    utc8 = timezone(timedelta(hours=8))
+    # 2. 獲取當前的 UTC+8 時間
+    now_utc8 = datetime.now(utc8)
+    # 3. 格式化為 'YYYY-MM-DD HH:MM:SS' 字串 (isoformat 不經 strftime 的格式解析)
+    return now_utc8.replace(tzinfo=None).isoformat(sep=' ', timespec='seconds')
+
+def update_user_log(user_id_card, successful_url, timestamp=None):
+    """寫入使用者的 last_time 與 last_link；timestamp 未指定時使用目前時間。"""
     if not GSPREAD_AVAILABLE: return
     with gsheet_lock:
         try:
             cleaned_id_card = str(user_id_card).strip().upper()
-            id_card_column = [str(val).strip().upper() for val in worksheet.col_values(2)]
-            try:
-                match_row = id_card_column.index(cleaned_id_card) + 1
-            except ValueError:
-                print(f"紀錄失敗：在 Google Sheet 中找不到使用者 {cleaned_id_card}。", file=sys.stderr)
+            match_row = _get_sheet_cache()['id_to_row'].get(cleaned_id_card)
+            if match_row is None:
+                # 可能是新加入的使用者，強制重新載入一次索引
+                match_row = _get_sheet_cache(force=True)['id_to_row'].get(cleaned_id_card)
+            if match_row is None:
+                app.logger.warning("紀錄失敗：在 Google Sheet 中找不到使用者 %s。", cleaned_id_card)
                 return
 
-            headers = worksheet.row_values(1)
-            
-            time_col_index = headers.index('last_time') + 1 if 'last_time' in headers else len(headers) + 1
-            if 'last_time' not in headers: worksheet.update_cell(1, time_col_index, 'last_time'); headers.append('last_time')
-            
-            # --- 時區修正 ---
-            # 1. 定義 UTC+8 時區 (台灣時間)
-            utc8 = timezone(timedelta(hours=8))
-            # 2. 獲取當前的 UTC+8 時間
-            now_utc8 = datetime.now(utc8)
-            # 3. 格式化為字串
-            timestamp = now_utc8.strftime('%Y-%m-%d %H:%M:%S')
-            
-            worksheet.update_cell(match_row, time_col_index, timestamp)
-
-            link_col_index = headers.index('last_link') + 1 if 'last_link' in headers else len(headers) + 1
-            if 'last_link' not in headers: worksheet.update_cell(1, link_col_index, 'last_link')
-            worksheet.update_cell(match_row, link_col_index, str(successful_url) if successful_url else "")
-
-            print(f"紀錄成功：使用者 {cleaned_id_card} 的 last_time 和 last_link 已更新。")
+            headers = list(_sheet_cache['headers'])
+            updates = []
+            for col_name in ('last_time', 'last_link'):
+                if col_name not in headers:
+                    headers.append(col_name)
+                    updates.append({'range': rowcol_to_a1(1, len(headers)), 'values': [[col_name]]})
+            time_col_index = headers.index('last_time') + 1
+            link_col_index = headers.index('last_link') + 1
+            if timestamp is None:
+                timestamp = log_timestamp()
+
+            # 將標題補齊與兩個儲存格的寫入合併為一次 API 請求
+            updates.append({'range': rowcol_to_a1(match_row, time_col_index), 'values': [[timestamp]]})
+            updates.append({'range': rowcol_to_a1(match_row, link_col_index), 'values': [[str(successful_url) if successful_url else ""]]})
+            worksheet.batch_update(updates, value_input_option='USER_ENTERED')
+            _sheet_cache['headers'] = headers
+
+            app.logger.debug("紀錄成功：使用者 %s 的 last_time 和 last_link 已更新。", cleaned_id_card)
         except Exception as e:
-            print(f"更新 Google Sheet 時發生錯誤：{e}", file=sys.stderr)
+            app.logger.error("更新 Google Sheet 時發生錯誤：%s", e)
+            # 寫入失敗時快取可能已與工作表不一致 (例如欄位或列被調整)，下次強制重新載入
+            invalidate_sheet_cache()
+
+def enqueue_user_log(user_id_card, successful_url):
+    """將紀錄排入背景寫入；同一使用者已有待寫入的紀錄時直接覆蓋，不重複排程。"""
+    if not GSPREAD_AVAILABLE: return
+    cleaned_id_card = str(user_id_card).strip().upper()
+    # 時間於產生證書當下記錄，不受背景佇列等待時間影響
+    timestamp = log_timestamp()
+    with _pending_logs_lock:
+        already_queued = cleaned_id_card in _pending_logs
+        _pending_logs[cleaned_id_card] = (successful_url, timestamp)
+    if not already_queued:
+        _log_executor.submit(_flush_user_log, cleaned_id_card)
+
+def _flush_user_log(cleaned_id_card):
+    with _pending_logs_lock:
+        successful_url, timestamp = _pending_logs.pop(cleaned_id_card)
+    update_user_log(cleaned_id_card, successful_url, timestamp)
+
+# ==============================================================================
+# PDF 證書產生
+# ==============================================================================
+def create_certificate_pdf(output, activity, user_name, user_number):
+    """以 ReportLab 繪製完賽證明，直接寫入 output (檔名或可寫入的檔案物件)。"""
+    # 明確啟用串流壓縮，不依賴 rl_config 的預設值；TTFont 只嵌入實際用到的字形子集
+    p = canvas.Canvas(output, pagesize=letter, pageCompression=1)
+
+    p.setFont(CERT_FONT, 36)
+    p.drawString(TITLE_X, PAGE_HEIGHT - 100, "完賽證明")
+
+    p.setFont(CERT_FONT, 18)
+    p.drawCentredString(PAGE_WIDTH / 2.0, PAGE_HEIGHT - 200, f"恭喜 {user_name} (編號: {user_number})")
+    p.drawString(SUBTITLE_X, PAGE_HEIGHT - 250, "挑戰成功")
+    for label, key, y in CERT_STAT_LINES:
+        value = str(activity.get(key, 'N/A'))
+        x = (PAGE_WIDTH - CERT_LABEL_WIDTHS[label] - pdfmetrics.stringWidth(value, CERT_FONT, 18)) / 2.0
+        p.drawString(x, y, label + value)
+
+    p.showPage()
+    p.save()
+
+def _evict_pdf_cache():
+    """PDF 快取超過 PDF_CACHE_MAX_FILES 時，依修改時間刪除最久未使用的檔案。"""
+    entries = [entry for entry in os.scandir(PDF_CACHE_DIR) if entry.name.endswith('.pdf')]
+    if len(entries) <= PDF_CACHE_MAX_FILES: return
+    # 快取目錄由所有 worker 共用，檔案可能已被其他行程淘汰，略過即可
+    mtimes = []
+    for entry in entries:
+        try:
+            mtimes.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            continue
+    mtimes.sort()
+    for _, path in mtimes[:len(mtimes) - PDF_CACHE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def get_certificate_path(activity, user_id_card, user_name, user_number):
+    """
+    回傳 (證書 PDF 的快取檔案路徑, 快取鍵)。
+    快取鍵由證書上所有會顯示的內容計算而得，快取不存在時才產生並以原子方式寫入。
+    """
+    key_source = '|'.join(str(value) for value in (
+        user_id_card, user_name, user_number,
+        activity.get('distance'), activity.get('time'),
+        activity.get('elevation_gain'), activity.get('avg_pace'),
+    ))
+    key = hashlib.blake2b(key_source.encode('utf-8'), digest_size=16).hexdigest()
+    pdf_path = os.path.join(PDF_CACHE_DIR, f'{key}.pdf')
+
+    try:
+        os.utime(pdf_path)  # 更新修改時間，作為 LRU 淘汰依據
+        return pdf_path, key
+    except FileNotFoundError:
+        pass  # 尚未產生或剛被其他 worker 淘汰，重新產生
+
+    # ReportLab 直接寫入快取目錄中的暫存檔，不經過額外的記憶體緩衝區
+    fd, tmp_path = tempfile.mkstemp(dir=PDF_CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            create_certificate_pdf(f, activity, user_name, user_number)
+        os.replace(tmp_path, pdf_path)
+    except BaseException:
+        # 產生失敗時移除暫存檔 (淘汰機制只處理 .pdf，不會清到 .tmp)
+        os.unlink(tmp_path)
+        raise
+    _evict_pdf_cache()
+    return pdf_path, key
 
 # ==============================================================================
 # 路由 (Routes)
@@ -273,54 +567,50 @@ def process_activity():
         flash('請輸入活動網址。', 'warning')
         return redirect(url_for('index'))
 
-    activities = None
-    if url_type == 'garmin':
-        activities = get_garmin_data(url)
-    elif url_type == 'strava':
-        activities = get_strava_data(url)
-    else:
+    if url_type not in ACTIVITY_SCRAPERS:
         flash('請選擇有效的平台。', 'warning')
         return redirect(url_for('index'))
+    activities = get_activity_data(url_type, url)
     
     if activities:
         # 直接選取第一個活動來產生證書
         activity = activities
         
-        # 更新後台紀錄
-        update_user_log(session.get('user_id_card'), url)
-
-        # 產生 PDF
-        buffer = BytesIO()
-        p = canvas.Canvas(buffer, pagesize=letter)
-        width, height = letter
-
-        p.setFont('NotoSansTC' if FONT_AVAILABLE else 'Helvetica', 36)
-        p.drawCentredString(width / 2.0, height - 100, "完賽證明")
-
-        p.setFont('NotoSansTC' if FONT_AVAILABLE else 'Helvetica', 18)
-        user_name = session.get('user_name', '')
-        user_number = session.get('user_number', '')
-
-        p.drawCentredString(width / 2.0, height - 200, f"恭喜 {user_name} (編號: {user_number})")
-        p.drawCentredString(width / 2.0, height - 250, "挑戰成功")
-        p.drawCentredString(width / 2.0, height - 350, f"總距離：{activity.get('distance', 'N/A')}")
-        p.drawCentredString(width / 2.0, height - 400, f"總時長：{activity.get('time', 'N/A')}")
-        p.drawCentredString(width / 2.0, height - 450, f"最高海拔：{activity.get('elevation_gain', 'N/A')}")
-        p.drawCentredString(width / 2.0, height - 500, f"平均配速：{activity.get('avg_pace', 'N/A')}")
-
-        p.showPage()
-        p.save()
-        buffer.seek(0)
-        
-        safe_activity_name = quote(activity.get('activity_name', 'activity').replace(" ", "_"))
-        filename = f"certificate.pdf"
+        # 更新後台紀錄 (交由背景執行緒處理，不阻塞 PDF 回傳)
+        enqueue_user_log(session.get('user_id_card'), url)
 
-        return Response(buffer, mimetype='application/pdf',
-                        headers={'Content-Disposition': f'attachment;filename="{filename}"'})
+        # 產生 PDF (相同內容的證書直接使用磁碟快取)
+        _, cache_key = get_certificate_path(activity, session.get('user_id_card'),
+                                            session.get('user_name', ''), session.get('user_number', ''))
+        session['certificate_key'] = cache_key
+
+        # 轉向 GET 下載網址，讓瀏覽器可用 ETag 進行條件式請求
+        return redirect(url_for('download_certificate', cache_key=cache_key))
     else:
         flash('抓取或解析資料失敗，請確認網址是否正確且頁面為公開。', 'danger')
         return redirect(url_for('index'))
 
+@app.route('/certificate/<cache_key>', methods=['GET'])
+def download_certificate(cache_key):
+    if 'user_id_card' not in session:
+        flash('使用者未登入，請先登入。', 'warning')
+        return redirect(url_for('login'))
+
+    pdf_path = os.path.join(PDF_CACHE_DIR, f'{cache_key}.pdf')
+    if session.get('certificate_key') != cache_key or not os.path.exists(pdf_path):
+        flash('找不到證書檔案，請重新產生。', 'warning')
+        return redirect(url_for('index'))
+
+    # 快取鍵即內容雜湊，作為 ETag 讓重複下載可直接回應 304 Not Modified；
+    # 網址內容永不改變，允許瀏覽器快取一天
+    response = send_file(pdf_path, mimetype='application/pdf', as_attachment=True,
+                         download_name="certificate.pdf", etag=cache_key, conditional=True,
+                         max_age=CERT_CACHE_MAX_AGE)
+    # 證書含個人資料，僅允許瀏覽器快取，不可由代理伺服器共用
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if 'user_id_card' in session: return redirect(url_for('index'))
@@ -332,26 +622,18 @@ def login():
         id_card_input = request.form.get('id_card', '').strip().upper()
         phone_input = request.form.get('phone', '').strip()
         
-        users_df = get_user_data()
-        if users_df is None or users_df.empty:
+        users = get_users()
+        if not users:
             flash('無法讀取或資料庫無使用者資料。', 'danger')
             return render_template('login.html')
-        
-        if not all(col in users_df.columns for col in ['id_card', 'phone']):
-            flash('資料庫欄位設定錯誤，請聯繫管理員。', 'danger')
-            return render_template('login.html')
 
-        df_id_card_col = users_df['id_card'].astype(str).str.strip().str.upper()
-        df_phone_col = users_df['phone'].astype(str).str.strip()
-        phone_input_no_zero = phone_input[1:] if phone_input.startswith('0') else phone_input
-        
-        user = users_df[
-            (df_id_card_col == id_card_input) & 
-            ((df_phone_col == phone_input) | (df_phone_col == phone_input_no_zero))
-        ]
+        user_info = find_user(users, id_card_input, phone_input)
+        if not user_info:
+            # 比對失敗可能是快取尚未包含剛新增或修改的資料，在限定頻率內重新讀取一次
+            users = get_users(max_age=USER_CACHE_MISS_TTL) or users
+            user_info = find_user(users, id_card_input, phone_input)
 
-        if not user.empty:
-            user_info = user.iloc[0]
+        if user_info:
             session['user_id_card'] = user_info['id_card']
             session['user_name'] = user_info['name']
             session['user_number'] = user_info['user_number']
@@ -372,5 +654,6 @@ def logout():
 # 應用程式啟動
 # ==============================================================================
 if __name__ == '__main__':
-    app.run(debug=True)
+    # 僅供本機開發；debug 模式 (除錯器與自動重新載入) 需以 FLASK_DEBUG=1 明確開啟
+    app.run(debug=os.environ.get('FLASK_DEBUG', '0') == '1')
 
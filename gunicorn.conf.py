@@ -0,0 +1,19 @@
+# Gunicorn 設定 (啟動方式: gunicorn app:app)
+# 請求大多在等待 Strava/Garmin 與 Google Sheets 的網路回應，使用多執行緒 worker；
+# 使用者與工作表快取為各 worker 行程獨立，PDF 磁碟快取則由所有 worker 共用
+import multiprocessing
+import os
+import sys
+
+# 各 worker 為獨立行程，未設定 SECRET_KEY 時每個 worker 會各自產生隨機金鑰，
+# 由其他 worker 簽署的 session cookie 會被拒絕 (隨機登出、證書下載轉址失敗)；
+# 不使用 preload_app，因為 gspread 連線於匯入時建立，不應在 fork 後共用
+if not os.environ.get('SECRET_KEY'):
+    sys.exit("錯誤：以 gunicorn 執行時必須設定環境變數 SECRET_KEY，所有 worker 才能共用同一把 session 金鑰。")
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '5000')}")
+workers = int(os.environ.get('GUNICORN_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 4)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+# 爬蟲連線逾時為 (5, 15) 秒並可重試，保留足夠餘裕
+timeout = 60